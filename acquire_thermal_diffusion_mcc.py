@@ -30,13 +30,84 @@ Author: Jerome Fung (jfung@ithaca.edu)
 '''
 
 import sys
-import numpy as np 
+import threading
+import time
+import numpy as np
 from mcculw import ul
 from mcculw.device_info import DaqDeviceInfo
-from mcculw.enums import InterfaceType, AnalogInputMode, ScanOptions, FunctionType
+from mcculw.enums import (InterfaceType, AnalogInputMode, ScanOptions,
+                          FunctionType, Status)
 
 import ctypes
 
+# pandas is optional: its C CSV writer is much faster than np.savetxt,
+# which formats one row at a time in Python
+try:
+    import pandas as pd
+    HAVE_PANDAS = True
+except ImportError:
+    HAVE_PANDAS = False
+
+# numba is optional: when present, conversion + deinterleave run as a single
+# compiled pass over the raw buffer instead of a LUT gather
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def make_convert(scale, offset, n_channels):
+    '''
+    Build a uint16 -> volts conversion kernel specialized for one board.
+
+    The affine constants and the channel count are captured in the
+    closure, so with numba they compile as literals: the channel loop
+    unrolls fully and scale/offset fold into the generated multiply-add.
+    Without numba the returned function is a plain broadcast multiply-add.
+
+    The returned kernel takes (raw, out, dt) with raw of shape
+    (points, n_channels) and out of shape (points, n_channels + 1); sample
+    times go into column 0 of out.
+    '''
+    if HAVE_NUMBA:
+        @njit(parallel = True, nogil = True, cache = True)
+        def convert(raw, out, dt):
+            for i in prange(raw.shape[0]):
+                out[i, 0] = i * dt
+                for k in range(n_channels):
+                    out[i, k + 1] = raw[i, k] * scale + offset
+    else:
+        def convert(raw, out, dt):
+            out[:, 0] = np.arange(raw.shape[0], dtype = np.float32) * np.float32(dt)
+            out[:, 1:] = (raw.astype(np.float32) * np.float32(scale)
+                          + np.float32(offset))
+    return convert
+
+
+def per_channel_views(raw_rows, copy = False):
+    '''
+    Split a (points, channels) scan array into per-channel 1-D arrays.
+
+    By default the channels come back as zero-copy strided views of the
+    interleaved data. For repeated per-channel work (filtering, thermistor
+    fits), pass copy = True to get physically contiguous per-channel
+    arrays, paying one transpose copy up front for unit-stride access
+    afterwards.
+
+    Parameters:
+        raw_rows (ndarray): 2-D array of shape (points, channels), e.g.
+            the saved _raw.npy file.
+        copy (bool): If True, return contiguous copies instead of views.
+
+    Returns:
+        List of 1-D arrays, one per channel, each of length points.
+    '''
+    if copy:
+        raw_rows = np.ascontiguousarray(raw_rows.T)
+        return [raw_rows[k] for k in range(len(raw_rows))]
+    return [raw_rows[:, k] for k in range(raw_rows.shape[1])]
+
 
 class MCCInterface:
     def __init__(self):
@@ -54,6 +125,18 @@ class MCCInterface:
         self.device_info = DaqDeviceInfo(self.board_number)
         self.ai_info = self.device_info.get_ai_info()
         self.ai_range = self.ai_info.supported_ranges[0]
+        # the code -> volts map is affine; recover its slope and intercept
+        # once from the endpoints so scans convert with a single vectorized
+        # multiply-add and no per-sample DLL calls
+        v_min = ul.to_eng_units(self.board_number, self.ai_range, 0)
+        v_max = ul.to_eng_units(self.board_number, self.ai_range, 65535)
+        self.v_scale = (v_max - v_min) / 65535.
+        self.v_offset = v_min
+        # bake the constants into a kernel specialized for this board, and
+        # warm it up so the first measurement doesn't pay the JIT cost
+        self._convert = make_convert(self.v_scale, self.v_offset, self.n_in_channels)
+        self._convert(np.zeros((1, self.n_in_channels), dtype = np.uint16),
+                      np.empty((1, self.n_in_channels + 1), dtype = np.float32), 1.)
         self.ao_info = self.device_info.get_ao_info()
         self.ao_range = self.ao_info.supported_ranges[0]
 
@@ -63,7 +146,26 @@ class MCCInterface:
         self.downsampled_rate = 100
 
         # configure single-ended input
-        ul.a_input_mode(self.board_number, AnalogInputMode.SINGLE_ENDED) 
+        ul.a_input_mode(self.board_number, AnalogInputMode.SINGLE_ENDED)
+
+        # DAQ buffers are pooled by size and reused across measurements in
+        # a session instead of being allocated and freed on every pulse
+        self._in_pool = {}
+        self._out_pool = {}
+        # remembers which pulse pattern each output buffer holds so
+        # repeated identical measurements skip rewriting it
+        self._out_pattern = {}
+
+    def close(self):
+        '''Release the pooled DAQ buffers and the device.'''
+        for memhandle in self._in_pool.values():
+            ul.win_buf_free(memhandle)
+        for memhandle in self._out_pool.values():
+            ul.win_buf_free(memhandle)
+        self._in_pool = {}
+        self._out_pool = {}
+        self._out_pattern = {}
+        ul.release_daq_device(self.board_number)
 
     def measure(self, pulse_length, lag_time, duration, outfname):
         total_meas_time_sec = lag_time + duration
@@ -71,22 +173,37 @@ class MCCInterface:
         aout_pts = np.floor(total_meas_time_sec * self.dac_rate).astype('int')
 
         total_input_pts = ain_pts_per_channel * self.n_in_channels
-         
-        # allocate memory buffer for input
-        input_memhandle = ul.win_buf_alloc(total_input_pts)
+
+        # allocate a ring buffer of two half-second halves for the input;
+        # each half is drained and converted while the scan keeps running
+        half_rows = self.adc_rate_per_channel // 2
+        ring_rows = 2 * half_rows
+        ring_pts = ring_rows * self.n_in_channels
+        if ring_pts not in self._in_pool:
+            self._in_pool[ring_pts] = ul.win_buf_alloc(ring_pts)
+        input_memhandle = self._in_pool[ring_pts]
         data_array = ctypes.cast(input_memhandle, ctypes.POINTER(ctypes.c_ushort))
+        # view the ring as (rows, channels) uint16 so conversion reads the
+        # DAQ buffer directly, with no flat intermediate or reshape
+        ring = np.ctypeslib.as_array(data_array, (ring_rows, self.n_in_channels))
 
-        # set up output
-        output_data = np.zeros(aout_pts, dtype = np.float64)
+        # set up output: write the heater pulse pattern directly into the
+        # pooled DAQ buffer; if the buffer already holds this pattern
+        # (swept measurements with fixed timing), reuse it as-is
         start_idx = np.floor(lag_time * self.dac_rate).astype('int')
         stop_idx = start_idx + np.floor(pulse_length * self.dac_rate).astype('int')
-        output_data[start_idx:stop_idx] = 5. # actual volts
-
-        # allocate a buffer for the output
-        output_memhandle = ul.scaled_win_buf_alloc(aout_pts)
-        # Get the pointer to the output data
-        output_ptr = output_data.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
-        ul.scaled_win_array_to_buf(output_ptr, output_memhandle, 0, aout_pts)
+        if aout_pts not in self._out_pool:
+            self._out_pool[aout_pts] = ul.scaled_win_buf_alloc(aout_pts)
+        output_memhandle = self._out_pool[aout_pts]
+        pattern = (aout_pts, start_idx, stop_idx)
+        if self._out_pattern.get(output_memhandle) != pattern:
+            # one pass into the buffer itself: no staging array and no
+            # scaled_win_array_to_buf copy
+            output_ptr = ctypes.cast(output_memhandle, ctypes.POINTER(ctypes.c_double))
+            output_data = np.ctypeslib.as_array(output_ptr, (int(aout_pts),))
+            output_data[:] = 0.
+            output_data[start_idx:stop_idx] = 5. # actual volts
+            self._out_pattern[output_memhandle] = pattern
 
         # Start analog output in background mode.
         # There will almost certainly be some timing offset, hopefully not too much
@@ -94,35 +211,105 @@ class MCCInterface:
         ul.a_out_scan(self.board_number, self.out_low_channel, self.out_high_channel,
                       aout_pts, self.dac_rate, self.ao_range, output_memhandle, ao_options)
 
-        # start analog input scan
+        # start analog input scan in the background, wrapping continuously
+        # around the two-half ring buffer
+        ai_options = ScanOptions.BACKGROUND | ScanOptions.CONTINUOUS
         actual_rate = ul.a_in_scan(self.board_number, self.in_low_channel, self.in_high_channel,
-                                   total_input_pts, self.adc_rate_per_channel, self.ai_range, input_memhandle, 
-                                   0)
-
-        # convert to numpy array
-        np_data_array = np.ctypeslib.as_array(data_array, (total_input_pts,))
-
-        # convert from integer values to volts
-        # want to include times in the output data
-        # to avoid a concatenate/copy, initialize the entire array
-        voltage_array = np.zeros(total_input_pts + ain_pts_per_channel)
-        # interleave the times
-        voltage_array[::(self.n_in_channels+1)] = np.arange(ain_pts_per_channel)/actual_rate
-        for i in np.arange(len(np_data_array)):
-            voltage_array[i + 1 + np.floor(i/self.n_in_channels).astype('int')] = ul.to_eng_units(self.board_number, 
-                                                                                                  self.ai_range, 
-                                                                                                  np_data_array[i])
-        # reshape
-        voltage_array = voltage_array.reshape(-1, self.n_in_channels + 1)
-
-        # save
-        np.save(outfname + '.npy', voltage_array)
-        np.save(outfname + '_100Hz.npy', voltage_array[::100])
-        np.savetxt(outfname + '_100Hz.txt', voltage_array[::100])
-
-        # free memory and clean up
-        ul.win_buf_free(input_memhandle)
-        #ul.win_buf_free(output_handle)
+                                   ring_pts, self.adc_rate_per_channel, self.ai_range, input_memhandle,
+                                   ai_options)
+        dt = 1. / actual_rate
+
+        # keep the acquired data as raw uint16 ADC codes until after
+        # decimation: the archival file stores the codes as-is (8x smaller
+        # than float64), and only the downsampled rows are converted to
+        # volts. backed by the output .npy file so the drain loop writes
+        # straight to disk
+        raw_array = np.lib.format.open_memmap(
+            outfname + '_raw.npy', mode = 'w+', dtype = np.uint16,
+            shape = (int(ain_pts_per_channel), self.n_in_channels))
+
+        # drain completed halves into the raw file from a worker thread;
+        # the ctypes ul calls and the nogil numba kernel release the GIL
+        # (the numpy copies do not), so the main thread stays mostly free
+        # while the scan runs. any failure in the worker is captured and
+        # re-raised after join so a dead thread can't pass for a good run
+        drain_error = []
+
+        def drain():
+            try:
+                drained = 0 # rows copied out of the ring so far
+                while drained < ain_pts_per_channel:
+                    status, curr_count, curr_index = ul.get_status(self.board_number,
+                                                                   FunctionType.AIFUNCTION)
+                    scan_rows = curr_count // self.n_in_channels
+                    if scan_rows - drained > ring_rows:
+                        # the continuous scan lapped the drain: undrained
+                        # halves were overwritten, so the archive is torn
+                        raise RuntimeError('input ring buffer overrun: scan is '
+                                           '%d rows ahead of the drain'
+                                           % (scan_rows - drained))
+                    # the scan is continuous, so ignore anything past what we want
+                    curr_rows = min(scan_rows, ain_pts_per_channel)
+                    while (curr_rows - drained >= half_rows
+                           or (curr_rows == ain_pts_per_channel and curr_rows > drained)):
+                        n_new = min(half_rows, curr_rows - drained)
+                        i0 = drained % ring_rows
+                        raw_array[drained:drained + n_new] = ring[i0:i0 + n_new]
+                        drained += n_new
+                    if drained < ain_pts_per_channel:
+                        if status != Status.RUNNING:
+                            # a stalled scan would otherwise leave this loop
+                            # sleeping forever waiting for rows
+                            raise RuntimeError('input scan stopped early with '
+                                               '%d of %d rows acquired'
+                                               % (curr_rows, ain_pts_per_channel))
+                        # sleep until the next half (or the end of the scan) is
+                        # due rather than polling at a fixed fine interval
+                        rows_due = min(drained + half_rows, ain_pts_per_channel)
+                        time.sleep(max((rows_due - curr_rows) * dt, 0.01))
+            except Exception as err:
+                drain_error.append(err)
+
+        drain_thread = threading.Thread(target = drain)
+        drain_thread.start()
+        # nothing else for the main thread to do yet; block until the
+        # final drain finishes
+        drain_thread.join()
+
+        ul.stop_background(self.board_number, FunctionType.AIFUNCTION)
+
+        if drain_error:
+            # don't save a partial run as if it succeeded
+            raise drain_error[0]
+
+        # convert only the decimated rows to volts: 1/decim of the samples
+        # ever touch a float array
+        decim = self.adc_rate_per_channel // self.downsampled_rate
+        ds_rows = np.ascontiguousarray(raw_array[::decim])
+        n_ds = len(ds_rows)
+        # float32 carries the 12-bit ADC resolution comfortably and halves
+        # the file size and memory traffic relative to float64
+        downsampled = np.empty((n_ds, self.n_in_channels + 1), dtype = np.float32)
+        self._convert(ds_rows, downsampled, decim * dt)
+
+        # save (the raw file was written in place by the drain loop)
+        raw_array.flush()
+        # sidecar making the raw archive self-describing offline:
+        # volts = codes * v_scale + v_offset, rows are 1/actual_rate apart
+        np.savez(outfname + '_raw_meta.npz', v_scale = self.v_scale,
+                 v_offset = self.v_offset, actual_rate = actual_rate,
+                 n_in_channels = self.n_in_channels)
+        np.save(outfname + '_100Hz.npy', downsampled)
+        if HAVE_PANDAS:
+            pd.DataFrame(downsampled).to_csv(outfname + '_100Hz.txt', sep = '\t',
+                                             header = False, index = False,
+                                             float_format = '%.6e')
+        else:
+            np.savetxt(outfname + '_100Hz.txt', downsampled, fmt = '%.6e')
+
+        # clean up; pooled buffers are kept for the next measurement and
+        # released by close()
+        ring = None
         data_array = None
         ul.stop_background(self.board_number, FunctionType.AOFUNCTION)
 
@@ -131,5 +318,6 @@ class MCCInterface:
 if __name__ == "__main__":
     interface = MCCInterface()
     interface.measure(float(sys.argv[1]), float(sys.argv[2]), float(sys.argv[3]), sys.argv[4])
+    interface.close()
 
 
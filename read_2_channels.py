@@ -18,6 +18,12 @@ class MCCInterface:
         self.device_info = DaqDeviceInfo(self.board_number)
         self.ai_info = self.device_info.get_ai_info()
         self.ai_range = self.ai_info.supported_ranges[0]
+        # the code -> volts map is affine; recover its slope and intercept
+        # once so scans convert with a single vectorized multiply-add
+        v_min = ul.to_eng_units(self.board_number, self.ai_range, 0)
+        v_max = ul.to_eng_units(self.board_number, self.ai_range, 65535)
+        self.v_scale = (v_max - v_min) / 65535.
+        self.v_offset = v_min
 
         # configure single-ended input
         ul.a_input_mode(self.board_number, AnalogInputMode.SINGLE_ENDED) 
@@ -38,11 +44,8 @@ class MCCInterface:
         # convert to numpy array
         np_data_array = np.ctypeslib.as_array(data_array, (total_count,))
 
-        # convert from integer to volts
-        voltage_array = np.zeros(len(np_data_array))
-        for i in np.arange(len(np_data_array)):
-            voltage_array[i] = ul.to_eng_units(self.board_number, self.ai_range, 
-                                               np_data_array[i])
+        # convert from integer to volts: a single broadcast multiply-add
+        voltage_array = np_data_array * self.v_scale + self.v_offset
 
         np.save(outfname, voltage_array)
 
@@ -27,6 +27,12 @@ class MCCInterface:
         self.device_info = DaqDeviceInfo(self.board_number)
         self.ai_info = self.device_info.get_ai_info()
         self.ai_range = self.ai_info.supported_ranges[0]
+        # the code -> volts map is affine; recover its slope and intercept
+        # once so scans convert with a single vectorized multiply-add
+        v_min = ul.to_eng_units(self.board_number, self.ai_range, 0)
+        v_max = ul.to_eng_units(self.board_number, self.ai_range, 65535)
+        self.v_scale = (v_max - v_min) / 65535.
+        self.v_offset = v_min
         self.ao_info = self.device_info.get_ao_info()
         self.ao_range = self.ao_info.supported_ranges[0]
 
@@ -46,16 +52,16 @@ class MCCInterface:
         aout_rate = 100
         aout_duration = 30 # seconds
         aout_pts = aout_rate * aout_duration
-        output_data = np.zeros(aout_pts, dtype = np.float64)
+        # allocate a buffer for the output and write the pattern straight
+        # into it: no staging array, no scaled_win_array_to_buf copy
+        output_handle = ul.scaled_win_buf_alloc(aout_pts)
+        output_ptr = ctypes.cast(output_handle, ctypes.POINTER(ctypes.c_double))
+        output_data = np.ctypeslib.as_array(output_ptr, (aout_pts,))
+        output_data[:] = 0.
         output_data[100:200] = 5. # actual volts
         output_data[300:400] = 5. # actual volts
         output_data[500:700] = 5.
         output_data[800:810] = 5.
-        # allocate a buffer for the output
-        output_handle = ul.scaled_win_buf_alloc(aout_pts)
-        # Get the pointer to the output data
-        output_ptr = output_data.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
-        ul.scaled_win_array_to_buf(output_ptr, output_handle, 0, aout_pts)
 
         # Start analog output in background mode.
         # There will almost certainly be some timing offset, hopefully not too much
@@ -72,11 +78,8 @@ class MCCInterface:
         # convert to numpy array
         np_data_array = np.ctypeslib.as_array(data_array, (total_count,))
 
-        # convert from integer to volts
-        voltage_array = np.zeros(len(np_data_array))
-        for i in np.arange(len(np_data_array)):
-            voltage_array[i] = ul.to_eng_units(self.board_number, self.ai_range, 
-                                               np_data_array[i])
+        # convert from integer to volts: a single broadcast multiply-add
+        voltage_array = np_data_array * self.v_scale + self.v_offset
 
         # reshape
         voltage_array = voltage_array.reshape(-1, self.in_high_channel - self.in_low_channel + 1)